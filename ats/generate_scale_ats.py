@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+##############################################################################
+# COPYRIGHT Ericsson AB 2014
+#
+# The copyright to the computer program(s) herein is the property of
+# Ericsson AB. The programs may be used and/or copied only with written
+# permission from Ericsson AB. or in accordance with the terms and
+# conditions stipulated in the agreement/contract under which the
+# program(s) have been supplied.
+##############################################################################
+""" Generates the scale_*.at acceptance tests, which model many nodes,
+services and VCS clustered services and assert every service task of the
+resulting plan as well as the number of config tasks of every node. Run it
+from the ats directory after changing a scenario.
+"""
+
+import os
+
+HEADER = """\
+# Generated by generate_scale_ats.py, do not edit.
+# %s
+
+litp create -t os-profile -p /software/profiles/rhel_6_2 -o name='sample-profile' path='/profiles/node-iso/'
+litp create -t system -p /infrastructure/systems/system1 -o system_name='MN1VM'
+litp create -t storage-profile-base -p /infrastructure/storage/storage_profiles/profile_1
+
+litp create -t deployment -p /deployments/d1
+"""
+
+NODE = """\
+litp create -t node -p {node} -o hostname={hostname}
+litp create -t eth -p {node}/network_interfaces/nic0 -o device_name=eth0 network_name='nodes' macaddress='08:00:27:{mac}' ipaddress=10.10.{subnet}.{host}
+litp inherit -p {node}/system -s /infrastructure/systems/system1
+litp inherit -p {node}/os -s /software/profiles/rhel_6_2
+litp inherit -p {node}/storage_profile -s /infrastructure/storage/storage_profiles/profile_1
+"""
+
+SERVICE_TASK = ("assertConfigTask {hostname} service {name} {path} "
+                "enable='true' ensure='running' name='{name}'")
+
+TASK_COUNT = "assertNumberConfigTasks {hostname} {count}"
+
+
+def cluster_nodes(lines, cluster, nodes, offset):
+    """ Creates the cluster and its nodes and returns their (vpath,
+    hostname) pairs.
+    """
+    lines.append('litp create -t cluster -p %s' % cluster)
+    created = []
+    for n in range(nodes):
+        index = offset + n
+        node = '%s/nodes/n%d' % (cluster, n + 1)
+        hostname = 'node%d' % (index + 1)
+        lines.append(NODE.format(
+            node=node, hostname=hostname,
+            mac='%02x:%02x:%02x' % (index // 65536, index // 256 % 256,
+                                    index % 256),
+            subnet=10 + index // 250, host=index % 250 + 1))
+        created.append((node, hostname))
+    return created
+
+
+def services_scenario(clusters, nodes, services, ms_services):
+    """ Inherits the same services onto every node of every cluster and
+    onto the ms; create_plan must have one task per inherited service.
+    """
+    lines = [HEADER % ('%d clusters of %d nodes with %d services each and '
+                       '%d services on the ms' %
+                       (clusters, nodes, services, ms_services))]
+    all_nodes = []
+    for c in range(clusters):
+        all_nodes += cluster_nodes(lines, '/deployments/d1/clusters/c%d' %
+                                   (c + 1), nodes, c * nodes)
+    for s in range(services):
+        lines.append('litp create -t service -p /software/services/s%d '
+                     '-o service_name=scale-service%d' % (s, s))
+    asserts = []
+    for node, hostname in all_nodes:
+        for s in range(services):
+            path = '%s/services/s%d' % (node, s)
+            lines.append('litp inherit -p %s -s /software/services/s%d' %
+                         (path, s))
+            asserts.append(SERVICE_TASK.format(
+                hostname=hostname, name='scale-service%d' % s, path=path))
+        asserts.append(TASK_COUNT.format(hostname=hostname, count=services))
+    for s in range(ms_services):
+        path = '/ms/services/s%d' % s
+        lines.append('litp inherit -p %s -s /software/services/s%d' %
+                     (path, s))
+        asserts.append(SERVICE_TASK.format(
+            hostname='ms1', name='scale-service%d' % s, path=path))
+    asserts.append(TASK_COUNT.format(hostname='ms1', count=ms_services))
+    lines.append('')
+    lines.append('litp create_plan')
+    lines.extend(asserts)
+    return lines
+
+
+def vcs_scenario(nodes, services, vcs_services):
+    """ Adds VCS clustered services, whose applications get no service
+    task, next to services inherited onto every node of the cluster; the
+    per node task counts catch any extra task for the applications.
+    """
+    lines = [HEADER % ('%d nodes with %d services each and %d VCS '
+                       'clustered services' % (nodes, services,
+                                               vcs_services))]
+    cluster = '/deployments/d1/clusters/c1'
+    all_nodes = cluster_nodes(lines, cluster, nodes, 0)
+    node_list = ','.join('n%d' % (n + 1) for n in range(nodes))
+    for v in range(vcs_services):
+        lines.append(
+            'litp create -t vcs-clustered-service -p %s/services/cs%d -o '
+            'active=%d standby=0 name=cs%d online_timeout=45 '
+            "node_list='%s'" % (cluster, v, nodes, v, node_list))
+        lines.append('litp create -t service -p /software/services/vcs%d '
+                     '-o service_name=scale-vcs%d' % (v, v))
+        lines.append('litp inherit -p %s/services/cs%d/applications/vcs%d '
+                     '-s /software/services/vcs%d' % (cluster, v, v, v))
+    for s in range(services):
+        lines.append('litp create -t service -p /software/services/s%d '
+                     '-o service_name=scale-service%d' % (s, s))
+    asserts = []
+    for node, hostname in all_nodes:
+        for s in range(services):
+            path = '%s/services/s%d' % (node, s)
+            lines.append('litp inherit -p %s -s /software/services/s%d' %
+                         (path, s))
+            asserts.append(SERVICE_TASK.format(
+                hostname=hostname, name='scale-service%d' % s, path=path))
+        asserts.append(TASK_COUNT.format(hostname=hostname, count=services))
+    lines.append('')
+    lines.append('litp create_plan')
+    lines.extend(asserts)
+    lines.append('')
+    lines.append('# A node service managed by VCS fails the whole plan')
+    lines.append('litp inherit -p %s/services/vcs0 -s /software/services/'
+                 'vcs0' % all_nodes[-1][0])
+    lines.append('assertErrorMessage \'Create plan failed: Service '
+                 '"scale-vcs0" is managed by the VCS plugin\' create_plan')
+    return lines
+
+
+SCENARIOS = {
+    'scale_services_many_nodes.at': lambda: services_scenario(
+        clusters=2, nodes=25, services=20, ms_services=5),
+    'scale_vcs_clustered_services.at': lambda: vcs_scenario(
+        nodes=10, services=10, vcs_services=20),
+}
+
+
+def main():
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for name, scenario in sorted(SCENARIOS.items()):
+        with open(os.path.join(directory, name), 'w') as at:
+            at.write('\n'.join(scenario()) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+##############################################################################
+# COPYRIGHT Ericsson AB 2014
+#
+# The copyright to the computer program(s) herein is the property of
+# Ericsson AB. The programs may be used and/or copied only with written
+# permission from Ericsson AB. or in accordance with the terms and
+# conditions stipulated in the agreement/contract under which the
+# program(s) have been supplied.
+##############################################################################
+
+import threading
+import time
+
+from litp.core.litp_logging import LitpLogger
+from service_plugin.settings import SETTINGS
+
+log = LitpLogger()
+
+COUNTERS = ('nodes', 'services', 'tasks', 'errors')
+
+
+class _NullMeasurement(object):
+    """ Measurement handed out while instrumentation is disabled; it records
+    nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def record(self, **counters):
+        pass
+
+
+NULL_MEASUREMENT = _NullMeasurement()
+
+
+class Measurement(object):
+    """ Times one call and collects its item counts.
+    """
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.counters = {}
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instrumentation.add(self.name, time.time() - self.start,
+                                 self.counters)
+        return False
+
+    def record(self, **counters):
+        """ Sets item counts (nodes, services, tasks, errors) of the call.
+        """
+        self.counters.update(counters)
+
+
+class Instrumentation(object):
+    """ Opt-in wall time and item count statistics of the service plugin
+    calls. Each call is written as a structured line to the trace log and
+    accumulated per call name in the dictionary returned by ``as_dict``.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def measure(self, name):
+        """ Returns a context manager that times the named call, or one that
+        does nothing when instrumentation is disabled.
+        """
+        if not self.enabled:
+            return NULL_MEASUREMENT
+        return Measurement(self, name)
+
+    def add(self, name, wall_time, counters):
+        line = 'service_plugin.stats call=%s wall_time=%.6f %s' % (
+            name, wall_time,
+            ' '.join('%s=%s' % (c, counters.get(c, 0)) for c in COUNTERS))
+        log.trace.info(line)
+        with self._lock:
+            stats = self._stats.setdefault(name, dict(
+                [('calls', 0), ('wall_time', 0.0)] +
+                [(c, 0) for c in COUNTERS]))
+            stats['calls'] += 1
+            stats['wall_time'] += wall_time
+            for counter in COUNTERS:
+                stats[counter] += counters.get(counter, 0)
+            stats['last'] = dict(counters, wall_time=wall_time)
+
+    def as_dict(self):
+        """ Returns the accumulated statistics keyed by call name.
+        """
+        with self._lock:
+            return dict((name, dict(stats))
+                        for name, stats in self._stats.items())
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+STATS = Instrumentation(SETTINGS.getboolean('instrumentation'))
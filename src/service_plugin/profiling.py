@@ -0,0 +1,112 @@
+##############################################################################
+# COPYRIGHT Ericsson AB 2014
+#
+# The copyright to the computer program(s) herein is the property of
+# Ericsson AB. The programs may be used and/or copied only with written
+# permission from Ericsson AB. or in accordance with the terms and
+# conditions stipulated in the agreement/contract under which the
+# program(s) have been supplied.
+##############################################################################
+
+import cProfile
+import functools
+import glob
+import os
+import pstats
+import time
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from litp.core.litp_logging import LitpLogger
+from service_plugin.settings import SETTINGS
+
+log = LitpLogger()
+
+# Setting it to 1 enables profiling without editing service_plugin.conf.
+PROFILING_ENV = 'SERVICE_PLUGIN_PROFILING'
+
+
+class Profiler(object):
+    """ Opt-in cProfile capture of the plugin entry points. Every profiled
+    call writes a pstats file to ``directory``, keeping the ``keep`` newest
+    ones per call name, and logs its ``top`` functions by cumulative time to
+    the trace log. Only the calling thread is profiled.
+    """
+
+    def __init__(self, enabled=False, directory='/var/tmp', keep=10,
+                 top=20):
+        self.enabled = enabled
+        self.directory = directory
+        self.keep = keep
+        self.top = top
+
+    @classmethod
+    def from_settings(cls, settings, environ=os.environ):
+        enabled = settings.getboolean('profiling') or \
+            environ.get(PROFILING_ENV, '').strip().lower() in \
+            ('1', 'yes', 'true', 'on')
+        return cls(enabled, settings.get('profiling_dir'),
+                   settings.getint('profiling_keep'),
+                   settings.getint('profiling_top'))
+
+    def profiled(self, name):
+        """ Decorator profiling every call of the method while the profiler
+        is enabled.
+        """
+        def decorator(method):
+            @functools.wraps(method)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return method(*args, **kwargs)
+                return self.run(name, method, *args, **kwargs)
+            return wrapper
+        return decorator
+
+    def run(self, name, function, *args, **kwargs):
+        """ Calls the function under cProfile and reports the profile under
+        the given name. The call runs unprofiled when another profiler is
+        already active.
+        """
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as e:
+            log.trace.warning('Could not profile %s: %s' % (name, e))
+            return function(*args, **kwargs)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profile.disable()
+            self.report(name, profile)
+
+    def report(self, name, profile):
+        """ Writes the pstats file of the call, drops the oldest files of the
+        same call name and logs the summary.
+        """
+        path = os.path.join(self.directory, '%s-%d-%d.pstats' % (
+            name, int(time.time() * 1000000), os.getpid()))
+        try:
+            profile.dump_stats(path)
+            self.rotate(name)
+        except (IOError, OSError) as e:
+            log.trace.warning('Could not write profile of %s to "%s": %s' %
+                              (name, path, e))
+            path = None
+        summary = StringIO()
+        stats = pstats.Stats(profile, stream=summary)
+        stats.sort_stats('cumulative').print_stats(self.top)
+        log.trace.info('service_plugin.profile call=%s file=%s\n%s' %
+                       (name, path, summary.getvalue()))
+        return path
+
+    def rotate(self, name):
+        files = sorted(glob.glob(os.path.join(self.directory,
+                                              '%s-*.pstats' % name)))
+        for path in files[:max(len(files) - self.keep, 0)]:
+            os.remove(path)
+
+
+PROFILER = Profiler.from_settings(SETTINGS)
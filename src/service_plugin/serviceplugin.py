@@ -8,11 +8,19 @@
 # program(s) have been supplied.
 ##############################################################################
 
+import hashlib
+import itertools
+from multiprocessing.pool import ThreadPool
+
 from litp.core.plugin import Plugin
 from litp.core.validators import ValidationError
 from litp.core.task import ConfigTask
 from litp.core.litp_logging import LitpLogger
 from litp.extensions.core_extension import CoreExtension
+from service_plugin.settings import SETTINGS
+from service_plugin.instrumentation import STATS
+from service_plugin.cache import LRUCache
+from service_plugin.profiling import PROFILER
 
 log = LitpLogger()
 
@@ -25,113 +33,779 @@ def debug(preamble, msg):
     log.trace.debug("%s: %s" % (preamble, msg))
 
 
-class ServiceValidator(object):
-    """ This class contains all the validators for the ServicePlugin.
+def validator(*item_types):
+    """ Marks a method of ServiceValidator as a validation rule that only
+    needs to run when items of the given types have changed, as told by
+    ``DeploymentSnapshot.has_changes``. A rule without item types runs on
+    every validation.
+    """
+    def decorate(method):
+        method.item_types = item_types
+        return method
+    return decorate
+
+
+def register_validators(cls):
+    """ Collects, once at class creation, the rules marked with
+    ``@validator`` in ``cls.VALIDATORS`` as (name, item_types) pairs sorted
+    by name.
+    """
+    cls.VALIDATORS = tuple(sorted(
+        (name, getattr(cls, name).item_types) for name in dir(cls)
+        if getattr(getattr(cls, name), 'item_types', None) is not None))
+    return cls
+
+
+class DisallowedServicesPolicy(object):
+    """ Immutable set of service names that cannot be managed by this
+    plugin, keyed by the item type of the node (``ms``, ``node``, ...).
+    Node types without an entry of their own get the default set.
+    """
+
+    __slots__ = ('_disallowed', '_default')
+
+    def __init__(self, disallowed, default=()):
+        default = frozenset(default)
+        object.__setattr__(self, '_default', default)
+        object.__setattr__(self, '_disallowed', dict(
+            (item_type, frozenset(names) | default)
+            for item_type, names in disallowed.items()))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is immutable' % self.__class__.__name__)
+
+    def for_type(self, item_type_id):
+        """ Returns the service names disallowed on nodes of the type.
+        """
+        return self._disallowed.get(item_type_id, self._default)
+
+    def for_node(self, node):
+        return self.for_type(node.item_type_id)
+
+    def extended(self, settings):
+        """ Returns a new policy with the names of the
+        ``disallowed_services`` setting added for every node type and the
+        ones of ``disallowed_services.<type>`` added for that type only.
+        """
+        common = settings.getlist('disallowed_services')
+        disallowed = dict((item_type, names | frozenset(common))
+                          for item_type, names in self._disallowed.items())
+        for item_type in settings.suffixes('disallowed_services'):
+            extra = settings.getlist('disallowed_services.%s' % item_type)
+            disallowed[item_type] = self.for_type(item_type) | \
+                frozenset(common) | frozenset(extra)
+        return DisallowedServicesPolicy(disallowed,
+                                        self._default | frozenset(common))
+
+
+DISALLOWED_SERVICES = DisallowedServicesPolicy({
+    'ms': ['litpd', 'rabbitmq-server', 'httpd', 'puppetmaster'],
+    'node': ['sshd'],
+}, default=CoreExtension.DISALLOWED_SERVICES_GLOBAL).extended(SETTINGS)
+
+
+class ServiceTaskTemplate(object):
+    """ Properties shared by the service ConfigTasks of one item type: the
+    ``enable`` value of a running service, the properties that are the same
+    for every item and the default start, stop and status commands, which
+    are formatted with the ``service_name`` when the item does not set them.
     """
 
-    DISALLOWED_SERVICES_FOR_MS = [
-        'litpd', 'rabbitmq-server', 'httpd', 'puppetmaster'
-    ] + CoreExtension.DISALLOWED_SERVICES_GLOBAL
+    COMMANDS = (
+        ('start', 'start_command'),
+        ('stop', 'stop_command'),
+        ('status', 'status_command'),
+    )
+
+    __slots__ = ('enable', 'constants', 'defaults')
+
+    def __init__(self, enable, constants=None, defaults=None):
+        self.enable = enable
+        self.constants = constants or {}
+        self.defaults = defaults or {}
+
+    def props(self, service):
+        """ Returns the ConfigTask properties of the service item.
+        """
+        props = dict(self.constants)
+        service_name = service.service_name
+        if service_name:
+            props['name'] = service_name
+        for prop, attr in self.COMMANDS:
+            command = getattr(service, attr)
+            if command:
+                props[prop] = command
+            elif prop in self.defaults:
+                props[prop] = self.defaults[prop].format(service_name)
+        return props
+
+
+VM_SERVICE_STATUS_COMMANDS = {
+    'adaptor': '/opt/ericsson/nms/litp/lib/litpmnlibvirt/'
+               'litp_libvirt_adaptor.py {0} status',
+    'systemd': 'systemctl is-active --quiet {0}',
+}
+
+
+def vm_service_template(status='adaptor'):
+    """ Returns the template of the vm-service tasks. ``status`` selects the
+    default status command: ``adaptor`` runs the libvirt adaptor, while
+    ``systemd`` asks systemd for the state of the unit without starting a
+    Python interpreter. Unknown strategies fall back to the adaptor.
+    """
+    if status not in VM_SERVICE_STATUS_COMMANDS:
+        log.trace.warning('Unknown vm-service status strategy "%s", using '
+                          '"adaptor"' % status)
+        status = 'adaptor'
+    return ServiceTaskTemplate(
+        'false',
+        constants={'hasstatus': 'false', 'provider': 'init'},
+        defaults={
+            'start': 'systemctl restart {0}',
+            'stop': 'systemctl stop {0}',
+            'status': VM_SERVICE_STATUS_COMMANDS[status],
+        })
+
+
+SERVICE_TASK_TEMPLATES = {
+    'service': ServiceTaskTemplate('true'),
+    'vm-service': vm_service_template(SETTINGS.get('vm_service_status')),
+}
+
+
+LIBVIRT_ADAPTOR_INSTALL = ("libvirt::install_adaptor",
+                           "ms_libvirt_adaptor_install")
+
+LIBVIRT_REQUIREMENTS = LRUCache(SETTINGS.getint('libvirt_requirements_cache'))
+
+
+def libvirt_requirements(hostname, service_name):
+    """ Returns the libvirt calls a vm-service task on the ms requires. The
+    tuples are built once per (hostname, service_name) and shared by every
+    later plan; the adaptor install call is the same tuple for all of them.
+    """
+    key = (hostname, service_name)
+    requires = LIBVIRT_REQUIREMENTS.get(key)
+    if requires is None:
+        requires = (
+            LIBVIRT_ADAPTOR_INSTALL,
+            ("libvirt::copy_file", hostname + "image" + service_name),
+            ("libvirt::write_file", hostname + "config" + service_name),
+            ("libvirt::write_file", hostname + "metadata" + service_name),
+            ("libvirt::write_file", hostname + "userdata" + service_name),
+        )
+        LIBVIRT_REQUIREMENTS.set(key, requires)
+    return requires
+
+
+class cached_property(object):
+    """ Property computed on first access and then stored on the instance.
+    """
 
-    DISALLOWED_SERVICES_FOR_NODES = ['sshd',
-    ] + CoreExtension.DISALLOWED_SERVICES_GLOBAL
+    def __init__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        value = obj.__dict__[self.func.__name__] = self.func(obj)
+        return value
+
+
+class ServiceRecord(object):
+    """ Compact view of a service item, read once per plan. It holds the
+    values the validators and the task builder read, so they do not go
+    through the model item on every access; ``item`` links back to the
+    model item for the ConfigTasks. Packages and applied properties are
+    only needed by tasks and are read from the item on demand.
+    """
+
+    __slots__ = ('item', 'vpath', 'item_type_id', 'service_name',
+                 'start_command', 'stop_command', 'status_command',
+                 'initial', 'updated', 'applied', 'for_removal')
+
+    def __init__(self, item):
+        self.item = item
+        self.vpath = item.vpath
+        self.item_type_id = item.item_type_id
+        self.service_name = item.service_name
+        self.start_command = item.start_command
+        self.stop_command = item.stop_command
+        self.status_command = item.status_command
+        self.initial = item.is_initial()
+        self.updated = item.is_updated()
+        self.applied = item.is_applied()
+        self.for_removal = item.is_for_removal()
+
+    @property
+    def packages(self):
+        return self.item.packages
+
+    @property
+    def applied_properties(self):
+        return self.item.applied_properties
+
+    @property
+    def applied_properties_determinable(self):
+        return getattr(self.item, 'applied_properties_determinable', True)
+
+    def get_vpath(self):
+        return self.vpath
+
+    def is_initial(self):
+        return self.initial
+
+    def is_updated(self):
+        return self.updated
+
+    def is_applied(self):
+        return self.applied
+
+    def is_for_removal(self):
+        return self.for_removal
+
+
+def model_item(service):
+    """ Returns the model item behind a ServiceRecord, or the given item.
+    """
+    return service.item if isinstance(service, ServiceRecord) else service
+
+
+def cluster_of(node):
+    """ Returns the vpath of the cluster of a node, or the node's own vpath
+    for the ms.
+    """
+    return node.vpath.rsplit('/nodes/', 1)[0]
+
+
+class DeploymentSnapshot(object):
+    """ Read-only view of the deployment shared by ``validate_model`` and
+    ``create_configuration`` of one plan.
+
+    A snapshot is used once: ``validate_model`` leaves it for the
+    ``create_configuration`` call that follows, if validation passed, and
+    that call drops it. It is ignored when ``create_configuration`` gets
+    another plugin API context. The plugin API has no model change signal,
+    so nothing else invalidates it.
+
+    The ms and node lists are queried when the snapshot is created. The
+    services of each node are queried once, the first time they are needed,
+    and kept as ServiceRecords. Everything derived from them is computed on
+    first use: the active ``service`` items of every node (``vm-service``
+    and items for removal are left out), the same items grouped by
+    ``service_name``, the ``redeploy_ms`` flag and, per cluster, the names
+    of the applications managed by ``vcs-clustered-service`` items.
+    """
 
     def __init__(self, plugin_api_context):
+        self.api = plugin_api_context
+        self.ms = plugin_api_context.query('ms')
+        self.nodes = plugin_api_context.query('node')
+        self._all_services = {}
+        self._fingerprints = {}
+        self._names_in_use = {}
+
+    @property
+    def all_nodes(self):
+        return self.nodes + self.ms
+
+    def all_services(self, node):
+        """ Returns a ServiceRecord of every item under the node that is a
+        ``service`` or a subtype of it.
+        """
+        services = self._all_services.get(node.vpath)
+        if services is None:
+            services = self._all_services[node.vpath] = [
+                ServiceRecord(service) for service in node.query('service')]
+        return services
+
+    @cached_property
+    def services(self):
+        """ The active ``service`` items, keyed by node vpath.
+        """
+        services = {}
+        for node in self.all_nodes:
+            services[node.vpath] = [
+                service for service in self.all_services(node)
+                if service.item_type_id == 'service' and
+                not service.is_for_removal()]
+        return services
+
+    @cached_property
+    def service_names(self):
+        """ The active ``service`` items, keyed by ``service_name``.
+        """
+        service_names = {}
+        for node in self.all_nodes:
+            for service in self.services[node.vpath]:
+                service_names.setdefault(service.service_name,
+                                         []).append(service)
+        return service_names
+
+    @cached_property
+    def service_count(self):
+        return sum(len(services) for services in self.services.values())
+
+    @cached_property
+    def redeploy_ms(self):
+        """ Whether an ``upgrade`` item of a peer node redeploys the ms.
+        """
+        return any(getattr(upgrd_item, 'redeploy_ms', 'false') == 'true'
+                   for node in self.nodes
+                   for upgrd_item in node.query('upgrade'))
+
+    @cached_property
+    def clustered_services(self):
+        """ The ``vcs-clustered-service`` items of every cluster, as
+        (cluster vpath, item, applications) triples.
+        """
+        clustered = []
+        for cluster in self.api.query('cluster'):
+            for service in cluster.services:
+                if service.item_type_id == 'vcs-clustered-service':
+                    clustered.append((cluster.vpath, service,
+                                      list(service.applications)))
+        return clustered
+
+    @cached_property
+    def vcs_services(self):
+        """ The names of the applications managed by VCS, keyed by cluster
+        vpath.
+        """
+        names = {}
+        for cluster, _, applications in self.clustered_services:
+            names.setdefault(cluster, set()).update(
+                a.service_name for a in applications)
+        return dict((cluster, frozenset(cluster_names))
+                    for cluster, cluster_names in names.items()
+                    if cluster_names)
+
+    def has_changes(self, item_type):
+        """ Whether an item of the given type that the validators read is
+        not Applied: a service of a node or of the ms for ``service``, a VCS
+        clustered service for ``vcs-clustered-service`` and an application
+        of a VCS clustered service for ``vcs-application``.
+        """
+        if item_type == 'vcs-clustered-service':
+            return any(not service.is_applied()
+                       for _, service, _ in self.clustered_services)
+        if item_type == 'vcs-application':
+            return any(not application.is_applied()
+                       for _, _, applications in self.clustered_services
+                       for application in applications)
+        return any(not service.is_applied()
+                   for node in self.all_nodes
+                   for service in self.all_services(node))
+
+    def node_services(self, node):
+        """ Returns the active ``service`` items of the given node.
+        """
+        return self.services.get(node.vpath, [])
+
+    def node_vcs_services(self, node):
+        """ Returns the names of the applications managed by VCS in the
+        cluster of the given node.
+        """
+        return self.vcs_services.get(cluster_of(node), frozenset())
+
+    def names_in_use(self, names):
+        """ Returns the names of the given frozenset that are the
+        ``service_name`` of an active service anywhere in the deployment.
+        Each distinct name is looked up once per set, however many nodes
+        inherit a service with that name.
+        """
+        in_use = self._names_in_use.get(names)
+        if in_use is None:
+            service_names = self.service_names
+            if len(names) <= len(service_names):
+                in_use = frozenset(n for n in names if n in service_names)
+            else:
+                in_use = frozenset(n for n in service_names if n in names)
+            self._names_in_use[names] = in_use
+        return in_use
+
+    def node_fingerprint(self, node):
+        """ Returns a digest of the vpath, type, state and service_name of
+        every service of the node and of the VCS applications of its
+        cluster, which is all the validators read.
+        """
+        fingerprint = self._fingerprints.get(node.vpath)
+        if fingerprint is None:
+            services = tuple(
+                (service.vpath, service.item_type_id, service.service_name,
+                 service.is_initial(), service.is_updated(),
+                 service.is_applied(), service.is_for_removal())
+                for service in self.all_services(node))
+            vcs_services = tuple(sorted(self.node_vcs_services(node)))
+            fingerprint = hashlib.sha1(repr((node.item_type_id, services,
+                                             vcs_services)).encode('utf-8'))
+            fingerprint = fingerprint.hexdigest()
+            self._fingerprints[node.vpath] = fingerprint
+        return fingerprint
+
+    def changed_services(self):
+        """ Returns (node, services) pairs with the service items of each
+        node or ms that are not Applied, in node order, leaving out the
+        nodes without any. The services already queried per node are used
+        when every node has been walked; otherwise the model is queried once
+        for service items, which are grouped under their owner by vpath.
+        """
+        all_nodes = self.all_nodes
+        if all(node.vpath in self._all_services for node in all_nodes):
+            changed = dict(
+                (node.vpath, [service for service in self.all_services(node)
+                              if not service.is_applied()])
+                for node in all_nodes)
+        else:
+            changed = dict((node.vpath, []) for node in all_nodes)
+            for service in self.api.query('service'):
+                if service.is_applied():
+                    continue
+                path = service.vpath
+                while path and path not in changed:
+                    path = path.rsplit('/', 1)[0]
+                if path:
+                    changed[path].append(ServiceRecord(service))
+        return [(node, changed[node.vpath]) for node in all_nodes
+                if changed[node.vpath]]
+
+
+@register_validators
+class ServiceValidator(object):
+    """ This class contains all the validators for the ServicePlugin.
+    """
+
+    DISALLOWED_SERVICES = DISALLOWED_SERVICES
+
+    def __init__(self, plugin_api_context, stats=STATS, workers=1,
+                 snapshot=None, cache=None, max_errors=0):
         """ Sets the plugin_api_context for use in every validator in this
-        class.
+        class, the Instrumentation the validation run reports to, the
+        number of threads the validators are run on, the DeploymentSnapshot
+        of the plan, if one is shared with the caller, the LRUCache of
+        per node errors kept between validation runs, if any, and the number
+        of errors after which validation stops, 0 meaning no limit.
         """
         self.api = plugin_api_context
+        self.stats = stats
+        self.workers = workers
+        self.snapshot = snapshot
+        self.cache = cache
+        self.max_errors = max_errors
+        self._index = None
+
+    @property
+    def index(self):
+        """ The snapshot shared by the validators of the current validation
+        run, or by the checks of the current validator call. Outside of
+        them, it is the snapshot of the plan, if one is shared, or a fresh
+        one.
+        """
+        if self._index is not None:
+            return self._index
+        return self.snapshot or DeploymentSnapshot(self.api)
 
-    def validate_duplicate_services(self):
+    @validator('service')
+    def validate_duplicate_services(self, lazy=False, counts=None):
         """ Checks whether has duplicated services names in the model for the
         same node.
         """
+        return self._nodes_errors(lambda index: index.nodes + index.ms,
+                                  self._duplicate_services, lazy, counts)
+
+    def _duplicate_services(self, node, counts=None):
         errors = []
         msg_format = 'Duplicate service "%s" defined on path: %s'
         msg_format_plr = 'Duplicate service "%s" defined on paths: %s'
-        nodes_paths = []
-        for node in self.api.query('node') + self.api.query('ms'):
-            paths = {}
-            for service in node.query('service'):
-                if service.is_for_removal() or \
-                   service.item_type_id != 'service':
-                    # ignore for removal ones
-                    continue
-                if service.service_name not in paths:
-                    paths[service.service_name] = {'service': service,
-                                                   'paths': []}
-                    continue
-                paths[service.service_name]['paths'].append(service)
-            nodes_paths.append(paths)
+        paths = {}
+        for service in self._node_services(node, counts):
+            if service.service_name not in paths:
+                paths[service.service_name] = {'service': service,
+                                               'paths': []}
+                continue
+            paths[service.service_name]['paths'].append(service)
 
-        for node_paths in nodes_paths:
-            for service_name, dup in node_paths.items():
-                if not dup['paths']:
-                    continue
-                form = msg_format_plr if len(dup['paths']) > 1 else msg_format
-                msg = form % (service_name,
-                            ','.join(['"%s"' % s.vpath for s in dup['paths']]))
-                errors.append(new_error(dup['service'], msg))
+        for service_name, dup in paths.items():
+            if not dup['paths']:
+                continue
+            form = msg_format_plr if len(dup['paths']) > 1 else msg_format
+            msg = form % (service_name,
+                        ','.join(['"%s"' % s.vpath for s in dup['paths']]))
+            errors.append(new_error(dup['service'], msg))
         return errors
 
-    def validate_not_allowed_services(self):
-        """ Based on DISALLOWED_SERVICES_* definition, this method checks
-        whether the services to be applied are valid or not.
+    @validator()
+    def validate_not_allowed_services(self, lazy=False, counts=None):
+        """ Based on the DISALLOWED_SERVICES policy, this method checks
+        whether the services to be applied are valid or not. The policy is
+        matched against the distinct service names of the deployment, and
+        only nodes whose policy matches one of them are walked. Applied
+        services are checked too, as the policy may have changed since they
+        were applied, so the rule runs on every validation.
         """
+        return self._nodes_errors(lambda index: index.ms + index.nodes,
+                                  self._not_allowed_services, lazy, counts)
+
+    def _not_allowed_services(self, node, counts=None):
         preamble = '.validate_not_allowed_services'
         errors = []
-        nodes_disallowed = [
-            (self.api.query('ms'), self.DISALLOWED_SERVICES_FOR_MS),
-            (self.api.query('node'), self.DISALLOWED_SERVICES_FOR_NODES),
-        ]
         msg_format = CoreExtension.DISALLOWED_SERVICES_VALIDATION_MESSAGE
-        for nodes, disallowed in nodes_disallowed:
-            for node in nodes:
-                for service in node.query('service'):
-                    if service.item_type_id != 'service' or \
-                       service.is_for_removal():
-                        continue
-                    if service.service_name in disallowed:
-                        msg = msg_format % service.service_name
-                        debug(preamble, msg)
-                        errors.append(new_error(service, msg))
+        disallowed = self.index.names_in_use(
+            self.DISALLOWED_SERVICES.for_node(node))
+        if not disallowed:
+            return errors
+        for service in self._node_services(node, counts):
+            if service.service_name in disallowed:
+                msg = msg_format % service.service_name
+                debug(preamble, msg)
+                errors.append(new_error(service, msg))
         return errors
 
-    def validate_over_vcs(self):
-        """ Checks whether services to be applied are managed by VCS plugin.
+    @validator('service', 'vcs-clustered-service', 'vcs-application')
+    def validate_over_vcs(self, lazy=False, counts=None):
+        """ Checks whether services to be applied are managed by VCS plugin
+        in the cluster of their node. Nodes of clusters whose VCS
+        applications match no service name of the deployment are skipped.
         """
+        return self._nodes_errors(lambda index: index.nodes, self._over_vcs,
+                                  lazy, counts)
+
+    def _over_vcs(self, node, counts=None):
         errors = []
-        vcs_services = []
         preamble = '.validate_over_vcs'
         msg_format = 'Service "%s" is managed by the VCS plugin'
-        for cluster in self.api.query('cluster'):
-            for service in cluster.services:
-                if service.item_type_id != 'vcs-clustered-service':
-                    continue
-                vcs_services += [a.service_name for a in service.applications]
+        vcs_services = self.index.names_in_use(
+            self.index.node_vcs_services(node))
         if not vcs_services:
-            return []
-        for node in self.api.query('node'):
-            for service in node.query('service'):
-                if service.item_type_id != 'service' or service.is_applied() \
-                   or service.is_for_removal():
-                    continue
-                if service.service_name in vcs_services:
-                    msg = msg_format % service.service_name
-                    debug(preamble, msg)
-                    errors.append(new_error(service, msg))
+            return errors
+        for service in self._node_services(node, counts):
+            if service.is_applied():
+                continue
+            if service.service_name in vcs_services:
+                msg = msg_format % service.service_name
+                debug(preamble, msg)
+                errors.append(new_error(service, msg))
         return errors
 
+    def _nodes_errors(self, nodes, check, lazy=False, counts=None):
+        """ Runs the per node check on the nodes that ``nodes`` returns for
+        the snapshot and returns the list of errors, or with ``lazy`` a
+        generator that checks each node only once the errors of the previous
+        ones have been consumed. The nodes the check runs on and the
+        services it inspects are added to ``counts``, if given.
+        """
+        errors = self._iter_nodes_errors(nodes, check, counts)
+        return errors if lazy else list(errors)
+
+    def _iter_nodes_errors(self, nodes, check, counts=None):
+        """ Yields the errors of the per node check, node by node. Outside
+        of a validation run, the snapshot is resolved once here and shared
+        by the checks of every node. With a cache, the errors of a node are
+        reused as long as the fingerprint of its services is unchanged.
+        """
+        owner = self._index is None
+        if owner:
+            self._index = self.index
+        try:
+            for node in nodes(self._index):
+                if self.cache is None:
+                    node_errors = self._check_node(node, check, counts)
+                else:
+                    key = (check.__name__, node.vpath,
+                           self._index.node_fingerprint(node))
+                    node_errors = self.cache.get(key)
+                    if node_errors is None:
+                        node_errors = self._check_node(node, check, counts)
+                        self.cache.set(key, node_errors)
+                for error in node_errors:
+                    yield error
+        finally:
+            if owner:
+                self._index = None
+
+    @staticmethod
+    def _check_node(node, check, counts):
+        if counts is not None:
+            counts['nodes'] += 1
+        return check(node, counts)
+
+    def _node_services(self, node, counts):
+        """ Returns the active services of the node a check inspects.
+        """
+        services = self.index.node_services(node)
+        if counts is not None:
+            counts['services'] += len(services)
+        return services
+
     def validate(self):
-        """ Executes every method of this class that starts with "validate_"
-        and retrieves every list of errors.
+        """ Executes every registered validator and retrieves every list of
+        errors. Validators whose item types have no changes in the model are
+        skipped. The model is walked once and the resulting index is shared
+        by every validator that runs; it also tells which item types
+        changed. With more than one worker the validators run on a thread
+        pool; their errors are still returned in the order of
+        ``VALIDATORS``. With ``max_errors`` set, the validators run one
+        after the other, whatever the number of workers, and stop as soon
+        as that many errors are found. Either way, every validator that runs
+        is recorded with the nodes it checked and the services it inspected.
+        """
+        errors = []
+        try:
+            with self.stats.measure('validate') as call:
+                with self.stats.measure('validate.index') as build:
+                    self._index = self.index
+                    names = self._changed_validators()
+                    build.record(**self._index_counters())
+                if self.max_errors > 0:
+                    errors = self._run_validators_capped(names)
+                else:
+                    for rule_errors in self._run_validators(names):
+                        errors += rule_errors
+                call.record(errors=len(errors))
+        finally:
+            self._index = None
+        return errors
+
+    def _changed_validators(self):
+        """ Returns the names of the validators without item types or with
+        changed ones, as told by the snapshot. Each item type is only looked
+        at once, and only while no earlier type of the validator has
+        changed.
+        """
+        preamble = '.validate'
+        names = []
+        changed = {}
+
+        def has_changes(item_type):
+            if item_type not in changed:
+                changed[item_type] = self.index.has_changes(item_type)
+            return changed[item_type]
+
+        for name, item_types in self.VALIDATORS:
+            if item_types and not any(has_changes(t) for t in item_types):
+                debug(preamble, 'Skipping %s, no changes in %s' %
+                      (name, ', '.join(item_types)))
+                continue
+            names.append(name)
+        return names
+
+    def iter_errors(self, names=None):
+        """ Yields the errors of the given validators, all of them by
+        default, in the order of ``VALIDATORS``. Each node is only checked
+        once the errors found so far have been consumed, so a caller that
+        stops early leaves the rest of the model unchecked.
+        """
+        if names is None:
+            names = [name for name, _ in self.VALIDATORS]
+        owner = self._index is None
+        if owner:
+            self._index = self.index
+        try:
+            for name in names:
+                for error in getattr(self, name)(lazy=True):
+                    yield error
+        finally:
+            if owner:
+                self._index = None
+
+    def _run_validators(self, names):
+        workers = min(self.workers, len(names))
+        if workers <= 1:
+            return [self._run_validator(name) for name in names]
+        pool = ThreadPool(processes=workers)
+        try:
+            return pool.map(self._run_validator, names)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _run_validators_capped(self, names):
+        """ Runs the validators lazily, one after the other, until
+        ``max_errors`` errors are found, recording each one that runs.
         """
         errors = []
-        for attr in dir(self):
-            if attr.startswith('validate_'):
-                errors += getattr(self, attr)()
+        for name in names:
+            remaining = self.max_errors - len(errors)
+            if remaining <= 0:
+                break
+            with self.stats.measure(name) as rule:
+                counts = {'nodes': 0, 'services': 0}
+                rule_errors = list(itertools.islice(
+                    getattr(self, name)(lazy=True, counts=counts), remaining))
+                rule.record(errors=len(rule_errors), **counts)
+            errors += rule_errors
         return errors
 
+    def _run_validator(self, name):
+        """ Runs one validator, recording the nodes it checked and the
+        services it inspected.
+        """
+        with self.stats.measure(name) as rule:
+            counts = {'nodes': 0, 'services': 0}
+            errors = getattr(self, name)(counts=counts)
+            rule.record(errors=len(errors), **counts)
+        return errors
+
+    def _index_counters(self):
+        return {'nodes': len(self._index.nodes) + len(self._index.ms),
+                'services': self._index.service_count}
+
+
+TASK_PROPERTIES = ('service_name', 'start_command', 'stop_command',
+                   'status_command')
+
+
+def has_task_changes(service):
+    """ Whether an Updated service item changed a property that reaches its
+    Puppet resource (name, start, stop and status). Items whose applied
+    properties are not determinable and ``vm-service`` items, whose tasks
+    also follow the libvirt ones, always count as changed.
+    """
+    if service.item_type_id != 'service' or \
+       not getattr(service, 'applied_properties_determinable', True):
+        return True
+    applied = service.applied_properties
+    return any(applied.get(name) != getattr(service, name)
+               for name in TASK_PROPERTIES)
+
+
+def unique_requirements(requires):
+    """ Returns the requirements without duplicates, keeping the first of
+    each. Model items are told apart by vpath, as a package of a service is
+    also found among the packages of its node through another query; call
+    tuples and vpaths are compared by value.
+    """
+    seen = set()
+    unique = []
+    for requirement in requires:
+        key = getattr(requirement, 'vpath', requirement)
+        if key not in seen:
+            seen.add(key)
+            unique.append(requirement)
+    return unique
+
+
+class RollingBatches(object):
+    """ Ordering hints of the service tasks. The nodes of each cluster are
+    put, in the order they are given, into rolling batches of ``size``
+    nodes, or all in batch 0 when ``size`` is 0. The tasks of one node never
+    require tasks of another node, so they are marked as independent across
+    nodes.
+    """
+
+    def __init__(self, size=0):
+        self.size = size
+        self._positions = {}
+
+    def hints(self, node):
+        cluster = cluster_of(node)
+        position = self._positions.get(cluster, 0)
+        self._positions[cluster] = position + 1
+        return {'cluster': cluster,
+                'batch': position // self.size if self.size > 0 else 0,
+                'independent_across_nodes': True}
+
 
 class ServicePlugin(Plugin):
     """
@@ -139,6 +813,24 @@ class ServicePlugin(Plugin):
     are running on either the management server or on peer nodes.
     """
 
+    def __init__(self, *args, **kwargs):
+        super(ServicePlugin, self).__init__(*args, **kwargs)
+        self.incremental = SETTINGS.getboolean('incremental_configuration')
+        self.stats = STATS
+        self.validation_workers = SETTINGS.getint('validation_workers')
+        cache_size = SETTINGS.getint('validation_cache')
+        self.validation_cache = LRUCache(cache_size) if cache_size else None
+        self.validation_error_limit = SETTINGS.getint(
+            'validation_error_limit')
+        if self.validation_error_limit > 0 and self.validation_workers > 1:
+            log.trace.warning('validation_workers is ignored while '
+                              'validation_error_limit is set, the rules run '
+                              'one after the other')
+        self.ordering_hints = SETTINGS.getboolean('ordering_hints')
+        self.rolling_batch_size = SETTINGS.getint('rolling_batch_size')
+        self._snapshot = None
+
+    @PROFILER.profiled('validate_model')
     def validate_model(self, plugin_api_context):
         """
         Validates LSB service model integrity. Validation rules enforced by
@@ -162,6 +854,10 @@ class ServicePlugin(Plugin):
             managed by LITP. In this case, it will fail at service item type
             creation.
 
+          - Further service names can be disallowed with the
+            ``disallowed_services`` setting of ``service_plugin.conf``, or
+            with ``disallowed_services.<type>`` for one node item type only.
+
           - The item of type ``service`` may be defined with \
             a ``start_command`` as the command that provides the action to
             start the service.
@@ -175,9 +871,18 @@ class ServicePlugin(Plugin):
             show the status of the service.
 
         """
-        validator = ServiceValidator(plugin_api_context)
-        return validator.validate()
+        snapshot = DeploymentSnapshot(plugin_api_context)
+        validator = ServiceValidator(plugin_api_context, stats=self.stats,
+                                     workers=self.validation_workers,
+                                     snapshot=snapshot,
+                                     cache=self.validation_cache,
+                                     max_errors=self.validation_error_limit)
+        errors = validator.validate()
+        # A plan that fails validation never reaches create_configuration
+        self._snapshot = None if errors else snapshot
+        return errors
 
+    @PROFILER.profiled('create_configuration')
     def create_configuration(self, plugin_api_context):
         """
         The following are examples of LSB service plugin usage. Note that
@@ -255,100 +960,134 @@ packages/crontabs" id="crontabs"/>
 from :ref:`LITP References <litp-references>`.
 
         """
-        redeploy_ms = any([True for node in plugin_api_context.query('node')
-                           for upgrd_item in node.query('upgrade')
-                     if getattr(upgrd_item, 'redeploy_ms', 'false') == 'true'])
+        with self.stats.measure('create_configuration') as call:
+            tasks = list(self.iter_configuration(plugin_api_context))
+            call.record(tasks=len(tasks))
+        return tasks
+
+    def iter_configuration(self, plugin_api_context):
+        """ Yields the tasks of ``create_configuration`` one node at a time,
+        so they can be consumed while the next nodes are still to be read
+        from the model. With ``ordering_hints``, every task gets the
+        ``ordering_hints`` of its node from ``RollingBatches``.
+        """
+        snapshot = self._take_snapshot(plugin_api_context)
+        with self.stats.measure('create_configuration.redeploy_ms') as phase:
+            redeploy_ms = snapshot.redeploy_ms
+            phase.record(nodes=len(snapshot.nodes))
 
+        if self.incremental:
+            with self.stats.measure(
+                    'create_configuration.changed_services') as phase:
+                nodes_services = snapshot.changed_services()
+                phase.record(nodes=len(nodes_services),
+                             services=sum(len(services) for _, services
+                                          in nodes_services))
+        else:
+            # The services of each node are read as its tasks are built,
+            # within the create_configuration.tasks phase
+            nodes_services = ((node, snapshot.all_services(node))
+                              for node in snapshot.all_nodes)
+
+        batches = RollingBatches(self.rolling_batch_size) \
+            if self.ordering_hints else None
+        nodes = inspected = emitted = 0
+        with self.stats.measure('create_configuration.tasks') as phase:
+            for node, services in nodes_services:
+                node_tasks = self._node_service_tasks(node, services,
+                                                      redeploy_ms)
+                nodes += 1
+                inspected += len(services)
+                emitted += len(node_tasks)
+                if batches is not None and node_tasks:
+                    hints = batches.hints(node)
+                    for task in node_tasks:
+                        task.ordering_hints = hints
+                for task in node_tasks:
+                    yield task
+            phase.record(nodes=nodes, services=inspected, tasks=emitted)
+
+    def _take_snapshot(self, plugin_api_context):
+        """ Returns the snapshot taken by ``validate_model`` of the same plan
+        or a new one. Either way it is not kept for a later call, as the
+        model may change before the next plan.
+        """
+        snapshot, self._snapshot = self._snapshot, None
+        if snapshot is None or snapshot.api is not plugin_api_context:
+            snapshot = DeploymentSnapshot(plugin_api_context)
+        return snapshot
+
+    def _node_service_tasks(self, node, services, redeploy_ms):
+        """ Builds the tasks of the given services of the node in one batch,
+        reading the node level values once for all of them.
+        """
         tasks = []
-        all_nodes = plugin_api_context.query('node') + \
-                    plugin_api_context.query('ms')
-        for node in all_nodes:
-            for service in node.query('service'):
-                if service.item_type_id == 'service' or \
-                  (service.item_type_id == 'vm-service' and
-                      node.item_type_id == 'ms'):
-
-                    if (node.is_ms() and redeploy_ms and
-                        'vm-service' == service.item_type_id and
-                        'esmon' == service.service_name):
-                        continue
-
-                    if service.is_initial() or service.is_updated():
-                        desc = 'Ensure service "%s" is running ' \
-                                'on node "%s"' % \
-                                (service.service_name, node.hostname)
-                        enable = ('false'
-                                  if service.item_type_id == 'vm-service'
-                                  else 'true')
-                        task = self._service_config_task(node, service,
-                            desc, ensure='running', enable=enable)
-                        for package in service.packages:
-                            task.requires.add(package)
-                        ms_packages = node.query('package')
-                        for package in ms_packages:
-                            if package.name == service.service_name:
-                                task.requires.add(package)
-                        if service.item_type_id == 'vm-service':
-                            task.requires.add(service)
-                        if (service.item_type_id == 'vm-service' and
-                                node.item_type_id == 'ms'):
-                            hostname = node.hostname
-                            ser_name = service.service_name
-                            task.requires.add(("libvirt::install_adaptor",
-                                              "ms_libvirt_adaptor_install"))
-                            task.requires.add(("libvirt::copy_file",
-                                              hostname + "image" + ser_name))
-                            task.requires.add(("libvirt::write_file",
-                                              hostname + "config" + ser_name))
-                            task.requires.add(("libvirt::write_file",
-                                              hostname + "metadata"
-                                               + ser_name))
-                            task.requires.add(("libvirt::write_file",
-                                              hostname + "userdata"
-                                               + ser_name))
-                        tasks.append(task)
-                    elif service.is_for_removal():
-                        desc = 'Stop service "%s" on node "%s"' % \
-                            (service.service_name, node.hostname)
-                        tasks.append(self._service_config_task(node, service,
-                            desc, ensure='stopped', enable='false'))
+        hostname = node.hostname
+        on_ms = node.item_type_id == 'ms'
+        skip_esmon = node.is_ms() and redeploy_ms
+        running = 'Ensure service "%s" is running on node "%s"'
+        stopped = 'Stop service "%s" on node "%s"'
+        node_packages = None
+        for service in services:
+            item_type_id = service.item_type_id
+            is_vm_service = item_type_id == 'vm-service'
+            if not (item_type_id == 'service' or (is_vm_service and on_ms)):
+                continue
+
+            if (skip_esmon and is_vm_service and
+                    'esmon' == service.service_name):
+                continue
+
+            template = SERVICE_TASK_TEMPLATES[item_type_id]
+            if service.is_initial() or \
+               (service.is_updated() and has_task_changes(service)):
+                desc = running % (service.service_name, hostname)
+                task = self._service_config_task(node, service, desc,
+                    ensure='running', enable=template.enable,
+                    template=template)
+                requires = list(service.packages)
+                if node_packages is None:
+                    node_packages = self._packages_by_name(node)
+                requires.extend(node_packages.get(service.service_name, []))
+                if is_vm_service:
+                    requires.append(model_item(service))
+                    requires.extend(libvirt_requirements(
+                        hostname, service.service_name))
+                task.requires.update(unique_requirements(requires))
+                tasks.append(task)
+            elif service.is_for_removal():
+                desc = stopped % (service.service_name, hostname)
+                tasks.append(self._service_config_task(node, service, desc,
+                    ensure='stopped', enable='false', template=template))
         return tasks
 
     @staticmethod
-    def _service_config_task(node, service, description, ensure, enable):
-        props = {}
-        if service.service_name:
-            props['name'] = service.service_name
-
-        if service.start_command:
-            props['start'] = service.start_command
-        elif service.item_type_id == 'vm-service':
-            props['start'] = "systemctl restart {0}".format(
-                service.service_name)
-
-        if service.stop_command:
-            props['stop'] = service.stop_command
-        elif service.item_type_id == 'vm-service':
-            props['stop'] = "systemctl stop {0}".format(
-                service.service_name)
-
-        if service.status_command:
-            props['status'] = service.status_command
-        elif service.item_type_id == 'vm-service':
-            props['status'] = "/opt/ericsson/nms/litp/lib/litpmnlibvirt/" \
-                              "litp_libvirt_adaptor.py {0} status".format(
-                service.service_name)
-        if service.item_type_id == 'vm-service':
-            props['hasstatus'] = "false"
-            props['provider'] = "init"
+    def _packages_by_name(node):
+        """ Indexes the packages of the node by package name, so every
+        service of the node is matched against it without another query.
+        """
+        packages = {}
+        for package in node.query('package'):
+            packages.setdefault(package.name, []).append(package)
+        return packages
 
+    @staticmethod
+    def _service_config_task(node, service, description, ensure, enable,
+                             template=None):
+        """ Returns the ``service`` ConfigTask of a ServiceRecord or of a
+        service item, with the properties of ``template``, by default the
+        template of its item type. The task references the model item.
+        """
+        if template is None:
+            template = SERVICE_TASK_TEMPLATES[service.item_type_id]
+        item = model_item(service)
         return ConfigTask(
             node,
-            service,
+            item,
             description,
             'service',
-            call_id=service.item_id,
+            call_id=item.item_id,
             ensure=ensure,
             enable=enable,
-            **props
+            **template.props(service)
         )
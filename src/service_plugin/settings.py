@@ -0,0 +1,95 @@
+##############################################################################
+# COPYRIGHT Ericsson AB 2014
+#
+# The copyright to the computer program(s) herein is the property of
+# Ericsson AB. The programs may be used and/or copied only with written
+# permission from Ericsson AB. or in accordance with the terms and
+# conditions stipulated in the agreement/contract under which the
+# program(s) have been supplied.
+##############################################################################
+
+try:
+    from ConfigParser import RawConfigParser, Error as ConfigError
+except ImportError:
+    from configparser import RawConfigParser, Error as ConfigError
+
+from litp.core.litp_logging import LitpLogger
+
+log = LitpLogger()
+
+PLUGIN_CONF = '/opt/ericsson/nms/litp/etc/plugins/service_plugin.conf'
+SETTINGS_SECTION = 'settings'
+
+DEFAULTS = {
+    'incremental_configuration': 'false',
+    'instrumentation': 'false',
+    'validation_workers': '1',
+    'validation_cache': '0',
+    'validation_error_limit': '0',
+    'ordering_hints': 'false',
+    'rolling_batch_size': '0',
+    'profiling': 'false',
+    'profiling_dir': '/var/tmp',
+    'profiling_keep': '10',
+    'profiling_top': '20',
+    'libvirt_requirements_cache': '1024',
+    'vm_service_status': 'adaptor',
+}
+
+TRUE_VALUES = ('1', 'yes', 'true', 'on')
+
+
+class ServicePluginSettings(object):
+    """ Tunables of the service plugin, read from the ``[settings]`` section
+    of ``service_plugin.conf``. Values not set there take the ones in
+    ``DEFAULTS``.
+    """
+
+    def __init__(self, values=None):
+        self._values = dict(DEFAULTS)
+        if values:
+            self._values.update(values)
+
+    @classmethod
+    def load(cls, path=PLUGIN_CONF):
+        """ Reads the settings from the given configuration file. A missing
+        file or section leaves every setting at its default.
+        """
+        parser = RawConfigParser()
+        try:
+            parser.read(path)
+            values = dict(parser.items(SETTINGS_SECTION)) \
+                if parser.has_section(SETTINGS_SECTION) else {}
+        except ConfigError as e:
+            log.trace.warning('Could not read settings from "%s": %s' %
+                              (path, e))
+            values = {}
+        return cls(values)
+
+    def get(self, name):
+        return self._values.get(name)
+
+    def getboolean(self, name):
+        return str(self.get(name)).strip().lower() in TRUE_VALUES
+
+    def getint(self, name):
+        try:
+            return int(self.get(name))
+        except (TypeError, ValueError):
+            return int(DEFAULTS[name])
+
+    def getlist(self, name):
+        """ Returns the comma separated values of the setting as a list.
+        """
+        value = self.get(name) or ''
+        return [v.strip() for v in value.split(',') if v.strip()]
+
+    def suffixes(self, prefix):
+        """ Returns the suffixes of the settings named ``<prefix>.<suffix>``.
+        """
+        prefix += '.'
+        return sorted(name[len(prefix):] for name in self._values
+                      if name.startswith(prefix))
+
+
+SETTINGS = ServicePluginSettings.load()
@@ -8,12 +8,24 @@
 # program(s) have been supplied.
 ##############################################################################
 
+import os
 import mock
+import shutil
+import tempfile
 import unittest
 import itertools
+from multiprocessing.pool import ThreadPool
 from mock import MagicMock
 
-from service_plugin.serviceplugin import ServicePlugin, ServiceValidator
+from service_plugin.serviceplugin import ServicePlugin, ServiceValidator, \
+    DeploymentSnapshot, SERVICE_TASK_TEMPLATES, LIBVIRT_ADAPTOR_INSTALL, \
+    LIBVIRT_REQUIREMENTS, libvirt_requirements, has_task_changes, \
+    vm_service_template, unique_requirements, ServiceRecord, \
+    DisallowedServicesPolicy
+from service_plugin.cache import LRUCache
+from service_plugin.settings import ServicePluginSettings
+from service_plugin.instrumentation import Instrumentation, NULL_MEASUREMENT
+from service_plugin.profiling import PROFILER, Profiler
 
 from litp.extensions.core_extension import CoreExtension
 from litp.core.model_manager import ModelManager
@@ -133,6 +145,20 @@ class TestServicePlugin(unittest.TestCase):
             raise Exception(". ".join([str(e) for e in item]))
         return item
 
+    def setup_mock_nodes(self, vpaths):
+        # Mock nodes at the given vpaths, each with one Initial service
+        # named after its hostname, and a plugin API context returning them
+        nodes = [MagicMock(item_type_id='node', hostname='node%d' % i,
+                           vpath=vpath)
+                 for i, vpath in enumerate(vpaths)]
+        for node in nodes:
+            node.query.side_effect = lambda t, node=node: [
+                MagicMock(item_type_id='service', is_initial=lambda: True,
+                          service_name=node.hostname, packages=[])
+            ] if 'service' == t else []
+        pac = MagicMock(query=lambda t: nodes if 'node' == t else [])
+        return nodes, pac
+
     def test_validate_model(self):
         self.setup_model()
         errors = self.plugin.validate_model(self.api)
@@ -383,3 +409,678 @@ class TestServicePlugin(unittest.TestCase):
         new_expected2 = template.format(mservice.service_name, ms.hostname)
         self.assertEqual(expected1, node_task.description)
         self.assertEqual(new_expected2, ms_task.description)
+
+    def test_validate_walks_model_once(self):
+        self.setup_model()
+        self.setup_apache_model()
+        self.setup_sentinel_model()
+        with mock.patch.object(self.api, 'query',
+                               wraps=self.api.query) as query:
+            errors = self.plugin.validate_model(self.api)
+        self.assertEqual(0, len(errors))
+        queried = [c[0][0] for c in query.call_args_list]
+        self.assertEqual(1, queried.count('node'))
+        self.assertEqual(1, queried.count('ms'))
+        self.assertEqual(1, queried.count('cluster'))
+        self.assertEqual(0, queried.count('service'))
+        self.assertEqual(0, queried.count('vcs-clustered-service'))
+
+    def test_validator_called_on_its_own_walks_model_once(self):
+        self.setup_model()
+        self.setup_sentinel_model()
+        self.create_item('node', '/deployments/d1/clusters/c1/nodes/n2',
+                         hostname='node2')
+        for name, _ in ServiceValidator.VALIDATORS:
+            with mock.patch.object(self.api, 'query',
+                                   wraps=self.api.query) as query:
+                self.assertEqual([], getattr(self.validator, name)())
+                self.assertEqual([], list(getattr(self.validator, name)(
+                    lazy=True)))
+            queried = [c[0][0] for c in query.call_args_list]
+            self.assertEqual(2, queried.count('node'), name)
+            self.assertEqual(2, queried.count('ms'), name)
+            self.assertTrue(queried.count('cluster') <= 2, name)
+
+    def test_model_index(self):
+        self.setup_model()
+        serv, serv_inh = self.setup_sentinel_model()
+        index = DeploymentSnapshot(self.api)
+        self.assertEqual(['/ms'], [n.vpath for n in index.ms])
+        self.assertEqual(['/deployments/d1/clusters/c1/nodes/n1'],
+                         [n.vpath for n in index.nodes])
+        self.assertEqual(['/ms/services/sentinel'],
+                         [s.vpath for s in index.node_services(index.ms[0])])
+        self.assertEqual(sorted(['/ms/services/sentinel', serv_inh.vpath]),
+                         sorted(s.vpath
+                                for s in index.service_names['sentinel']))
+        self.assertEqual({}, index.vcs_services)
+
+    def test_service_records(self):
+        self.setup_model()
+        item, inh = self.setup_sentinel_model()
+        snapshot = DeploymentSnapshot(self.api)
+        records = snapshot.all_services(self.node1)
+        self.assertEqual([inh.vpath], [r.vpath for r in records])
+        record = records[0]
+        self.assertTrue(isinstance(record, ServiceRecord))
+        self.assertFalse(hasattr(record, '__dict__'))
+        self.assertEqual(inh.vpath, record.item.vpath)
+        self.assertEqual('sentinel', record.service_name)
+        self.assertTrue(record.is_initial())
+        self.assertEqual([p.vpath for p in inh.packages],
+                         [p.vpath for p in record.packages])
+
+        for incremental in (False, True):
+            self.plugin.incremental = incremental
+            tasks = self.plugin.create_configuration(self.api)
+            self.assertEqual(2, len(tasks))
+            for task in tasks:
+                self.assertFalse(isinstance(task.model_item, ServiceRecord))
+                self.assertFalse(any(isinstance(r, ServiceRecord)
+                                     for r in task.requires))
+
+        # Every service task is created from its record by
+        # _service_config_task, which resolves the model item
+        task = self.plugin._service_config_task(self.node1, record, 'foo',
+                                                'running', 'true')
+        self.assertEqual(inh.vpath, task.model_item.vpath)
+        self.assertEqual(inh.item_id, task.call_id)
+        self.assertEqual('sentinel', task.kwargs['name'])
+        self.plugin.incremental = False
+        with mock.patch.object(ServicePlugin, '_service_config_task',
+                               wraps=self.plugin._service_config_task) as new:
+            tasks = self.plugin.create_configuration(self.api)
+        self.assertEqual(len(tasks), new.call_count)
+        self.assertTrue(all(isinstance(c[0][1], ServiceRecord)
+                            for c in new.call_args_list))
+
+    def test_create_configuration_package_scan_is_linear(self):
+
+        class Package(object):
+            reads = 0
+
+            def __init__(self, name):
+                self._name = name
+
+            @property
+            def name(self):
+                Package.reads += 1
+                return self._name
+
+        def run(num_services, num_packages):
+            services = [MagicMock(item_type_id='service',
+                                  is_initial=lambda: True,
+                                  service_name='service%d' % i,
+                                  packages=[])
+                        for i in range(num_services)]
+            packages = [Package('service%d' % i)
+                        for i in range(num_packages)]
+            queries = []
+
+            def ms_mock_query(itemtype):
+                queries.append(itemtype)
+                if 'service' == itemtype:
+                    return services
+                elif 'package' == itemtype:
+                    return packages
+                return []
+
+            ms = MagicMock(query=ms_mock_query, hostname='ms1',
+                           item_type_id='ms')
+            pac = MagicMock(query=lambda t: [ms] if 'ms' == t else [])
+            Package.reads = 0
+            tasks = self.plugin.create_configuration(pac)
+            self.assertEqual(num_services, len(tasks))
+            self.assertEqual(1, queries.count('package'))
+            for task in tasks:
+                self.assertEqual(1, len(task.requires))
+            return Package.reads
+
+        # Every package is looked at once per node, whatever the number
+        # of services, so the cost grows linearly with the package count.
+        self.assertEqual(100, run(10, 100))
+        self.assertEqual(100, run(50, 100))
+        self.assertEqual(400, run(50, 400))
+
+    def test_service_task_requirements_are_unique(self):
+        package = MagicMock(vpath='/ms/services/s0/packages/p')
+        same_package = MagicMock(vpath='/ms/services/s0/packages/p')
+        service = MagicMock(item_type_id='service', service_name='s0',
+                            start_command=None, stop_command=None,
+                            status_command=None, is_initial=lambda: True,
+                            packages=[package])
+        ms = MagicMock(item_type_id='ms', hostname='ms1')
+        ms.query.return_value = [same_package]
+        with mock.patch.object(self.plugin, '_packages_by_name',
+                               return_value={'s0': [same_package]}):
+            tasks = self.plugin._node_service_tasks(ms, [service], False)
+        self.assertEqual(set([package]), tasks[0].requires)
+
+        self.assertEqual(
+            [package, LIBVIRT_ADAPTOR_INSTALL, '/other'],
+            unique_requirements([package, LIBVIRT_ADAPTOR_INSTALL,
+                                 same_package, '/other',
+                                 LIBVIRT_ADAPTOR_INSTALL,
+                                 '/ms/services/s0/packages/p']))
+
+    def test_incremental_create_configuration(self):
+        self.setup_model()
+        item, inh = self.setup_sentinel_model()
+        full_tasks = self.plugin.create_configuration(self.api)
+
+        self.plugin.incremental = True
+        tasks = self.plugin.create_configuration(self.api)
+        self.assertEqual([(t.node.vpath, t.model_item.vpath, t.kwargs)
+                          for t in full_tasks],
+                         [(t.node.vpath, t.model_item.vpath, t.kwargs)
+                          for t in tasks])
+
+        with mock.patch.object(self.api, 'query',
+                               wraps=self.api.query) as query:
+            self.plugin.create_configuration(self.api)
+        queried = [c[0][0] for c in query.call_args_list]
+        self.assertEqual(1, queried.count('service'))
+
+    def test_disallowed_services_policy(self):
+        policy = ServiceValidator.DISALLOWED_SERVICES
+        for name in CoreExtension.DISALLOWED_SERVICES_GLOBAL:
+            self.assertTrue(name in policy.for_type('ms'))
+            self.assertTrue(name in policy.for_type('node'))
+            self.assertTrue(name in policy.for_type('other-node'))
+        self.assertTrue('litpd' in policy.for_type('ms'))
+        self.assertFalse('litpd' in policy.for_type('node'))
+        self.assertTrue('sshd' in policy.for_type('node'))
+        self.assertEqual(frozenset, type(policy.for_type('ms')))
+        self.assertRaises(AttributeError, setattr, policy, '_default', ())
+
+        settings = ServicePluginSettings({
+            'disallowed_services': 'foo, bar',
+            'disallowed_services.node': 'baz',
+            'disallowed_services.other-node': 'qux'})
+        extended = policy.extended(settings)
+        self.assertTrue('foo' in extended.for_type('ms'))
+        self.assertTrue('bar' in extended.for_type('other-node'))
+        self.assertTrue('baz' in extended.for_type('node'))
+        self.assertTrue('sshd' in extended.for_type('node'))
+        self.assertFalse('baz' in extended.for_type('ms'))
+        self.assertTrue('qux' in extended.for_type('other-node'))
+        self.assertFalse('qux' in extended.for_type('node'))
+        self.assertFalse('foo' in policy.for_type('ms'))
+
+    def test_validate_over_vcs_other_cluster(self):
+        self.setup_model()
+        self.create_item('cluster', '/deployments/d1/clusters/c2')
+        self.create_item(
+            'vcs-clustered-service',
+            '/deployments/d1/clusters/c2/services/apachecs',
+            active=1,
+            standby=0,
+            name='vcs1',
+            online_timeout=45,
+            node_list='n2'
+        )
+        self.create_item('service', '/software/services/service1',
+                         service_name='httpd')
+        self.model.create_inherited("/software/services/service1",
+            "/deployments/d1/clusters/c2/services/apachecs/"
+            "applications/service1")
+        self.setup_apache_model()
+        errors = self.validator.validate_over_vcs()
+        self.assertEqual(0, len(errors))
+        index = DeploymentSnapshot(self.api)
+        self.assertEqual({'/deployments/d1/clusters/c2': set(['httpd'])},
+                         index.vcs_services)
+        self.assertEqual(set(), index.node_vcs_services(self.node1))
+
+    def test_snapshot_has_changes(self):
+        self.setup_model()
+        self.setup_sentinel_model()
+        self.create_item(
+            'vcs-clustered-service',
+            '/deployments/d1/clusters/c1/services/apachecs',
+            active=1,
+            standby=0,
+            name='vcs1',
+            online_timeout=45,
+            node_list='n1'
+        )
+        self.model.set_all_applied()
+        self.create_item('service', '/software/services/service1',
+                         service_name='httpd')
+        self.model.create_inherited("/software/services/service1",
+            "/deployments/d1/clusters/c1/services/apachecs/"
+            "applications/service1")
+        snapshot = DeploymentSnapshot(self.api)
+        self.assertEqual([False, False, True],
+                         [snapshot.has_changes(item_type) for item_type in
+                          ('service', 'vcs-clustered-service',
+                           'vcs-application')])
+
+    def test_validator_registry(self):
+        self.assertEqual((
+            ('validate_duplicate_services', ('service',)),
+            ('validate_not_allowed_services', ()),
+            ('validate_over_vcs', ('service', 'vcs-clustered-service',
+                                   'vcs-application')),
+        ), ServiceValidator.VALIDATORS)
+
+    def test_validate_skips_unchanged_validators(self):
+        self.setup_model()
+        self.setup_sentinel_model()
+        self.model.set_all_applied()
+        with mock.patch.object(ServiceValidator,
+                               'validate_duplicate_services') as dup:
+            with mock.patch.object(ServiceValidator, 'validate_over_vcs',
+                                   return_value=[]) as vcs:
+                self.assertEqual([], self.plugin.validate_model(self.api))
+                self.assertFalse(dup.called)
+                self.assertFalse(vcs.called)
+
+                # The disallowed services policy may have changed since the
+                # services were applied, so that rule always runs
+                with mock.patch.object(
+                        ServiceValidator, 'DISALLOWED_SERVICES',
+                        DisallowedServicesPolicy({}, ['sentinel'])):
+                    errors = self.plugin.validate_model(self.api)
+                self.assertEqual(2, len(errors))
+
+                self.create_item(
+                    'vcs-clustered-service',
+                    '/deployments/d1/clusters/c1/services/apachecs',
+                    active=2,
+                    standby=0,
+                    name='vcs1',
+                    online_timeout=45,
+                    node_list='n1,n2'
+                )
+                self.assertEqual([], self.plugin.validate_model(self.api))
+                self.assertFalse(dup.called)
+                self.assertTrue(vcs.called)
+
+    def test_instrumentation(self):
+        self.setup_model()
+        self.setup_sentinel_model()
+        self.plugin.stats = Instrumentation(enabled=True)
+        with mock.patch('service_plugin.instrumentation.log') as log:
+            self.assertEqual([], self.plugin.validate_model(self.api))
+            tasks = self.plugin.create_configuration(self.api)
+        stats = self.plugin.stats.as_dict()
+        self.assertEqual(set(['validate', 'validate.index',
+                              'validate_duplicate_services',
+                              'validate_not_allowed_services',
+                              'validate_over_vcs',
+                              'create_configuration',
+                              'create_configuration.redeploy_ms',
+                              'create_configuration.tasks']),
+                         set(stats))
+        self.assertEqual(1, stats['validate_over_vcs']['calls'])
+        # The rules count the nodes they check and the services they
+        # inspect: sentinel is neither disallowed nor managed by VCS
+        self.assertEqual((2, 2),
+                         (stats['validate_duplicate_services']['nodes'],
+                          stats['validate_duplicate_services']['services']))
+        self.assertEqual((2, 0),
+                         (stats['validate_not_allowed_services']['nodes'],
+                          stats['validate_not_allowed_services']['services']))
+        self.assertEqual((1, 0), (stats['validate_over_vcs']['nodes'],
+                                  stats['validate_over_vcs']['services']))
+        self.assertEqual(2, stats['validate.index']['nodes'])
+        self.assertEqual(2, stats['validate.index']['services'])
+        self.assertEqual(len(tasks), stats['create_configuration']['tasks'])
+        self.assertEqual(2, stats['create_configuration.tasks']['services'])
+        self.assertEqual(2, stats['create_configuration.tasks']['nodes'])
+        self.assertEqual(len(stats), log.trace.info.call_count)
+        self.assertTrue(log.trace.info.call_args[0][0].startswith(
+            'service_plugin.stats call=create_configuration wall_time='))
+
+        self.plugin.incremental = True
+        self.plugin.create_configuration(self.api)
+        changed = self.plugin.stats.as_dict()[
+            'create_configuration.changed_services']
+        self.assertEqual((2, 2), (changed['nodes'], changed['services']))
+
+    def test_instrumentation_disabled(self):
+        self.setup_model()
+        self.plugin.stats = Instrumentation(enabled=False)
+        self.plugin.validate_model(self.api)
+        self.plugin.create_configuration(self.api)
+        self.assertEqual({}, self.plugin.stats.as_dict())
+        self.assertTrue(self.plugin.stats.measure('validate') is
+                        NULL_MEASUREMENT)
+
+    def test_profiling(self):
+        self.setup_model()
+        self.setup_sentinel_model()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        tasks = self.plugin.create_configuration(self.api)
+        with mock.patch.multiple(PROFILER, enabled=True, directory=directory,
+                                 keep=2, top=5):
+            with mock.patch('service_plugin.profiling.log') as log:
+                for _ in range(3):
+                    self.assertEqual([], self.plugin.validate_model(self.api))
+                profiled = self.plugin.create_configuration(self.api)
+        self.assertEqual(len(tasks), len(profiled))
+        files = sorted(os.listdir(directory))
+        self.assertEqual(3, len(files))
+        self.assertTrue(files[0].startswith('create_configuration-'))
+        self.assertTrue(all(f.startswith('validate_model-')
+                            for f in files[1:]))
+        summaries = [c[0][0] for c in log.trace.info.call_args_list]
+        self.assertEqual(4, len(summaries))
+        self.assertTrue(summaries[0].startswith(
+            'service_plugin.profile call=validate_model file=%s' %
+            directory))
+
+        settings = ServicePluginSettings()
+        self.assertFalse(Profiler.from_settings(settings, {}).enabled)
+        self.assertTrue(Profiler.from_settings(
+            settings, {'SERVICE_PLUGIN_PROFILING': '1'}).enabled)
+        self.assertTrue(Profiler.from_settings(
+            ServicePluginSettings({'profiling': 'true'}), {}).enabled)
+
+    def test_validate_parallel(self):
+        self.setup_model()
+        self.setup_apache_model()
+        for i in range(3):
+            self.create_item('service', '/ms/services/foo%d' % i,
+                             service_name='httpd')
+        serial = self.plugin.validate_model(self.api)
+        self.assertEqual(4, len(serial))
+
+        self.plugin.validation_workers = 4
+        with mock.patch('service_plugin.serviceplugin.ThreadPool',
+                        wraps=ThreadPool) as pool:
+            parallel = self.plugin.validate_model(self.api)
+        pool.assert_called_once_with(processes=3)
+        self.assertEqual([(e.item_path, e.error_message) for e in serial],
+                         [(e.item_path, e.error_message) for e in parallel])
+
+    def test_node_service_tasks_batch(self):
+        ms = MagicMock(item_type_id='ms', hostname='ms1')
+        services = [MagicMock(item_type_id=item_type_id,
+                              service_name='service%d' % i,
+                              start_command=None,
+                              stop_command=None,
+                              status_command=None,
+                              is_initial=lambda: True,
+                              packages=[])
+                    for i, item_type_id in enumerate(
+                        ['vm-service', 'service', 'vm-service'])]
+        ms.query.return_value = []
+        tasks = self.plugin._node_service_tasks(ms, services, False)
+        self.assertEqual(3, len(tasks))
+        self.assertEqual(['false', 'true', 'false'],
+                         [t.kwargs['enable'] for t in tasks])
+        self.assertEqual('systemctl restart service2',
+                         tasks[2].kwargs['start'])
+        self.assertFalse('start' in tasks[1].kwargs)
+        template = SERVICE_TASK_TEMPLATES['vm-service']
+        self.assertEqual({'hasstatus': 'false', 'provider': 'init'},
+                         template.constants)
+        tasks[0].kwargs['provider'] = 'systemd'
+        self.assertEqual('init', template.constants['provider'])
+        self.assertEqual('init', tasks[2].kwargs['provider'])
+
+    def test_updated_service_without_task_changes(self):
+        ms = MagicMock(item_type_id='ms', hostname='ms1')
+        ms.query.return_value = []
+        props = dict(service_name='sentinel',
+                     start_command='/etc/init.d/sentinel start',
+                     stop_command=None,
+                     status_command=None)
+
+        def updated_service(item_type_id, applied, determinable=True):
+            return MagicMock(item_type_id=item_type_id,
+                             is_initial=lambda: False,
+                             is_updated=lambda: True,
+                             is_for_removal=lambda: False,
+                             applied_properties=applied,
+                             applied_properties_determinable=determinable,
+                             packages=[], **props)
+
+        unchanged = dict(props, stop_command=None)
+        changed = dict(props, start_command='/etc/init.d/sentinel go')
+        services = [updated_service('service', unchanged),
+                    updated_service('service', changed),
+                    updated_service('service', unchanged, False),
+                    updated_service('vm-service', unchanged)]
+        tasks = self.plugin._node_service_tasks(ms, services, False)
+        self.assertEqual(services[1:], [t.model_item for t in tasks])
+
+        self.assertFalse(has_task_changes(services[0]))
+        self.assertTrue(has_task_changes(services[1]))
+
+    def test_vm_service_status_strategies(self):
+        service = MagicMock(service_name='vm1', start_command=None,
+                            stop_command=None, status_command=None)
+        expected = {
+            'adaptor': '/opt/ericsson/nms/litp/lib/litpmnlibvirt/'
+                       'litp_libvirt_adaptor.py vm1 status',
+            'systemd': 'systemctl is-active --quiet vm1',
+            'unknown': '/opt/ericsson/nms/litp/lib/litpmnlibvirt/'
+                       'litp_libvirt_adaptor.py vm1 status',
+        }
+        for strategy, status in expected.items():
+            props = vm_service_template(strategy).props(service)
+            self.assertEqual({'name': 'vm1',
+                              'hasstatus': 'false',
+                              'provider': 'init',
+                              'start': 'systemctl restart vm1',
+                              'stop': 'systemctl stop vm1',
+                              'status': status}, props)
+        self.assertEqual(expected['adaptor'],
+                         SERVICE_TASK_TEMPLATES['vm-service'].props(
+                             service)['status'])
+
+        service.status_command = '/bin/true'
+        props = vm_service_template('systemd').props(service)
+        self.assertEqual('/bin/true', props['status'])
+
+    def test_libvirt_requirements_are_memoized(self):
+        LIBVIRT_REQUIREMENTS.clear()
+        ms = MagicMock(item_type_id='ms', hostname='ms1')
+        ms.query.return_value = []
+        services = [MagicMock(item_type_id='vm-service',
+                              service_name='vm%d' % i,
+                              is_initial=lambda: True,
+                              packages=[])
+                    for i in range(5)]
+
+        for _ in range(3):
+            tasks = self.plugin._node_service_tasks(ms, services, False)
+            self.assertEqual(5, len(tasks))
+        # One set of requirement tuples built per vm-service, reused by the
+        # later plans.
+        self.assertEqual(5, LIBVIRT_REQUIREMENTS.misses)
+        self.assertEqual(10, LIBVIRT_REQUIREMENTS.hits)
+        self.assertEqual(5, len(LIBVIRT_REQUIREMENTS))
+
+        first = libvirt_requirements('ms1', 'vm0')
+        self.assertTrue(first is libvirt_requirements('ms1', 'vm0'))
+        self.assertTrue(first[0] is LIBVIRT_ADAPTOR_INSTALL)
+        self.assertTrue(libvirt_requirements('ms1', 'vm1')[0] is
+                        LIBVIRT_ADAPTOR_INSTALL)
+        for task in tasks:
+            self.assertTrue(LIBVIRT_ADAPTOR_INSTALL in task.requires)
+            self.assertEqual(6, len(task.requires))
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.set('c', 3)
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertEqual(2, len(cache))
+        self.assertEqual(3, cache.hits)
+        self.assertEqual(1, cache.misses)
+
+    def test_snapshot_shared_by_validate_and_create_configuration(self):
+        self.setup_model()
+        self.setup_sentinel_model()
+        with mock.patch.object(self.api, 'query',
+                               wraps=self.api.query) as query:
+            self.assertEqual([], self.plugin.validate_model(self.api))
+            tasks = self.plugin.create_configuration(self.api)
+        self.assertEqual(2, len(tasks))
+        queried = [c[0][0] for c in query.call_args_list]
+        self.assertEqual(1, queried.count('node'))
+        self.assertEqual(1, queried.count('ms'))
+
+        # The snapshot is only used by the plan that took it
+        with mock.patch.object(self.api, 'query',
+                               wraps=self.api.query) as query:
+            self.assertEqual(2, len(
+                self.plugin.create_configuration(self.api)))
+        queried = [c[0][0] for c in query.call_args_list]
+        self.assertEqual(1, queried.count('node'))
+
+        self.plugin.validate_model(self.api)
+        self.assertNotEqual(None, self.plugin._snapshot)
+
+        # A plan that fails validation does not keep its snapshot
+        self.create_item('service', '/ms/services/httpd',
+                         service_name="httpd")
+        self.assertEqual(1, len(self.plugin.validate_model(self.api)))
+        self.assertEqual(None, self.plugin._snapshot)
+
+    def test_snapshot_redeploy_ms(self):
+        upgrade = MagicMock(redeploy_ms='true')
+        node = MagicMock(vpath='/n1')
+        node.query.return_value = [upgrade]
+        pac = MagicMock(query=lambda t: [node] if 'node' == t else [])
+        snapshot = DeploymentSnapshot(pac)
+        self.assertTrue(snapshot.redeploy_ms)
+        upgrade.redeploy_ms = 'false'
+        self.assertTrue(snapshot.redeploy_ms)
+        self.assertFalse(DeploymentSnapshot(pac).redeploy_ms)
+
+    def test_iter_configuration(self):
+        nodes, pac = self.setup_mock_nodes(['/n%d' % i for i in range(3)])
+
+        tasks = self.plugin.iter_configuration(pac)
+        self.assertEqual('node0', next(tasks).kwargs['name'])
+        # Only the services of the nodes already consumed have been read
+        self.assertTrue(mock.call('service') in
+                        nodes[0].query.call_args_list)
+        self.assertFalse(mock.call('service') in
+                         nodes[2].query.call_args_list)
+        self.assertEqual(['node1', 'node2'],
+                         [t.kwargs['name'] for t in tasks])
+        self.assertEqual(3, len(self.plugin.create_configuration(pac)))
+
+    def test_ordering_hints(self):
+        _, pac = self.setup_mock_nodes(
+            ['/d/clusters/c%d/nodes/n%d' % (i % 2, i) for i in range(5)])
+
+        tasks = self.plugin.create_configuration(pac)
+        self.assertFalse(any(hasattr(t, 'ordering_hints') for t in tasks))
+
+        self.plugin.ordering_hints = True
+        self.plugin.rolling_batch_size = 2
+        tasks = self.plugin.create_configuration(pac)
+        self.assertEqual([('/d/clusters/c0', 0), ('/d/clusters/c1', 0),
+                          ('/d/clusters/c0', 0), ('/d/clusters/c1', 0),
+                          ('/d/clusters/c0', 1)],
+                         [(t.ordering_hints['cluster'],
+                           t.ordering_hints['batch']) for t in tasks])
+        self.assertTrue(all(t.ordering_hints['independent_across_nodes']
+                            for t in tasks))
+
+        self.plugin.rolling_batch_size = 0
+        tasks = self.plugin.create_configuration(pac)
+        self.assertEqual([0] * 5, [t.ordering_hints['batch'] for t in tasks])
+
+    def test_validate_distinct_service_names(self):
+        self.setup_model()
+        self.setup_sentinel_model()
+        snapshot = DeploymentSnapshot(self.api)
+        self.assertEqual(frozenset(['sentinel']),
+                         snapshot.names_in_use(frozenset(['sentinel', 'x'])))
+        validator = ServiceValidator(self.api, snapshot=snapshot)
+        with mock.patch.object(snapshot, 'node_services',
+                               wraps=snapshot.node_services) as walked:
+            self.assertEqual([], validator.validate_not_allowed_services())
+            self.assertEqual([], validator.validate_over_vcs())
+        self.assertFalse(walked.called)
+
+        self.setup_apache_model()
+        self.create_item('service', '/ms/services/httpd',
+                         service_name="httpd")
+        snapshot = DeploymentSnapshot(self.api)
+        validator = ServiceValidator(self.api, snapshot=snapshot)
+        with mock.patch.object(snapshot, 'node_services',
+                               wraps=snapshot.node_services) as walked:
+            errors = validator.validate_not_allowed_services()
+        self.assertEqual(['/ms/services/httpd'],
+                         [e.item_path for e in errors])
+        self.assertTrue(mock.call(snapshot.ms[0]) in walked.call_args_list)
+
+    def test_validation_error_limit(self):
+        self.setup_model()
+        self.setup_apache_model()
+        for name in ('httpd', 'litpd', 'puppetmaster'):
+            self.create_item('service', '/ms/services/%s' % name,
+                             service_name=name)
+        self.plugin.validation_cache = None
+        errors = self.plugin.validate_model(self.api)
+        self.assertEqual(3, len(errors))
+
+        self.plugin.validation_error_limit = 1
+        with mock.patch.object(ServiceValidator, '_not_allowed_services',
+                               wraps=self.validator._not_allowed_services
+                               ) as check:
+            check.__name__ = '_not_allowed_services'
+            limited = self.plugin.validate_model(self.api)
+        self.assertEqual([(e.item_path, e.error_message)
+                          for e in errors[:1]],
+                         [(e.item_path, e.error_message) for e in limited])
+        self.assertEqual(1, check.call_count)
+
+        # The rules that run are still recorded, up to where they stopped
+        self.plugin.stats = Instrumentation(enabled=True)
+        with mock.patch('service_plugin.instrumentation.log'):
+            self.plugin.validate_model(self.api)
+        stats = self.plugin.stats.as_dict()
+        self.assertEqual((1, 1),
+                         (stats['validate_not_allowed_services']['errors'],
+                          stats['validate_not_allowed_services']['nodes']))
+        self.assertEqual(0, stats['validate_duplicate_services']['errors'])
+        self.assertFalse('validate_over_vcs' in stats)
+
+        self.plugin.validation_error_limit = 2
+        self.assertEqual(2, len(self.plugin.validate_model(self.api)))
+
+        validator = ServiceValidator(self.api)
+        first = next(validator.iter_errors())
+        self.assertEqual(errors[0].item_path, first.item_path)
+
+    def test_validation_cache(self):
+        self.setup_model()
+        self.setup_apache_model()
+        item = self.create_item('service', '/ms/services/httpd',
+                                service_name="httpd")
+        # Off unless set in service_plugin.conf
+        self.assertEqual(None, self.plugin.validation_cache)
+        self.plugin.validation_cache = LRUCache(100)
+        errors = self.plugin.validate_model(self.api)
+        self.assertEqual(1, len(errors))
+        misses = self.plugin.validation_cache.misses
+
+        with mock.patch.object(ServiceValidator,
+                               '_not_allowed_services') as check:
+            check.__name__ = '_not_allowed_services'
+            cached = self.plugin.validate_model(self.api)
+            self.assertFalse(check.called)
+        self.assertEqual([(e.item_path, e.error_message) for e in errors],
+                         [(e.item_path, e.error_message) for e in cached])
+        self.assertEqual(misses, self.plugin.validation_cache.misses)
+
+        # Only the ms, whose services changed, is validated again by the
+        # two validators that check it
+        item.set_for_removal()
+        self.assertEqual([], self.plugin.validate_model(self.api))
+        self.assertEqual(misses + 2, self.plugin.validation_cache.misses)
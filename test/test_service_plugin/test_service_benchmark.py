@@ -0,0 +1,201 @@
+##############################################################################
+# COPYRIGHT Ericsson AB 2014
+#
+# The copyright to the computer program(s) herein is the property of
+# Ericsson AB. The programs may be used and/or copied only with written
+# permission from Ericsson AB. or in accordance with the terms and
+# conditions stipulated in the agreement/contract under which the
+# program(s) have been supplied.
+##############################################################################
+
+import json
+import os
+import time
+import unittest
+
+from service_plugin.serviceplugin import ServicePlugin
+
+from litp.extensions.core_extension import CoreExtension
+from litp.core.model_manager import ModelManager
+from litp.core.plugin_manager import PluginManager
+from litp.core.plugin_context_api import PluginApiContext
+from package_extension.package_extension import PackageExtension
+from vcs_extension.vcs_extension import VcsExtension
+from volmgr_extension.volmgr_extension import VolMgrExtension
+from network_extension.network_extension import NetworkExtension
+
+# Time budgets, in seconds, of each scenario. No baseline is shipped, as
+# wall clock times depend on the host: set
+# SERVICE_PLUGIN_BENCHMARK_UPDATE=1 on the reference host to store the
+# times measured there, with BASELINE_HEADROOM applied, in BASELINE_FILE.
+BASELINE_FILE = os.path.join(os.path.dirname(__file__),
+                             'benchmark_baseline.json')
+BASELINE_HEADROOM = 2.0
+
+# The large scenarios take a while to model, so they only run when
+# SERVICE_PLUGIN_BENCHMARK=all is set. The scenarios that run are only
+# checked against their time budgets, and fail without one, when
+# SERVICE_PLUGIN_BENCHMARK_CHECK=1 is set; otherwise they only check their
+# errors and task counts.
+RUN_LARGE = os.environ.get('SERVICE_PLUGIN_BENCHMARK') == 'all'
+CHECK_TIMES = os.environ.get('SERVICE_PLUGIN_BENCHMARK_CHECK') == '1'
+UPDATE_BASELINE = os.environ.get('SERVICE_PLUGIN_BENCHMARK_UPDATE') == '1'
+
+REPEAT = 3
+
+
+class TestServicePluginBenchmark(unittest.TestCase):
+    """ Times validate_model and create_configuration on generated models
+    with N nodes, M services per node, K packages on the ms and C VCS
+    clustered services, and compares the best time of each entry point
+    against the stored baseline.
+    """
+
+    dependent_apis = [
+        PackageExtension,
+        VcsExtension,
+        VolMgrExtension,
+        NetworkExtension
+    ]
+
+    @classmethod
+    def setUpClass(cls):
+        if os.path.exists(BASELINE_FILE):
+            with open(BASELINE_FILE) as baseline:
+                cls.baseline = json.load(baseline)
+        else:
+            cls.baseline = {}
+        cls.measured = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        if UPDATE_BASELINE and cls.measured:
+            cls.baseline.update(cls.measured)
+            with open(BASELINE_FILE, 'w') as baseline:
+                json.dump(cls.baseline, baseline, indent=4, sort_keys=True)
+
+    def setUp(self):
+        self.model = ModelManager()
+        self.api = PluginApiContext(self.model)
+        self.plugin_manager = PluginManager(self.model)
+        self.plugin_manager.add_property_types(
+            CoreExtension().define_property_types())
+        self.plugin_manager.add_item_types(
+            CoreExtension().define_item_types())
+        self.plugin_manager.add_default_model()
+        for Ext in self.dependent_apis:
+            ext = Ext()
+            self.plugin_manager.add_property_types(ext.define_property_types())
+            self.plugin_manager.add_item_types(ext.define_item_types())
+
+    def create_item(self, *args, **kwargs):
+        item = self.model.create_item(*args, **kwargs)
+        if isinstance(item, list):
+            raise Exception(". ".join([str(e) for e in item]))
+        return item
+
+    def create_inherited(self, *args):
+        item = self.model.create_inherited(*args)
+        if isinstance(item, list):
+            raise Exception(". ".join([str(e) for e in item]))
+        return item
+
+    def setup_deployment(self, nodes, services, packages, vcs_services):
+        self.create_item('ms', '/ms', hostname='ms1')
+        self.create_item('deployment', '/deployments/d1')
+        cluster = '/deployments/d1/clusters/c1'
+        self.create_item('cluster', cluster)
+
+        for i in range(services):
+            self.create_item('service', '/software/services/s%d' % i,
+                             service_name='service%d' % i)
+            self.create_item('package', '/software/items/s%d' % i,
+                             name='service%d' % i)
+            self.create_inherited('/software/items/s%d' % i,
+                                  '/software/services/s%d/packages/p' % i)
+
+        for n in range(nodes):
+            node = '%s/nodes/n%d' % (cluster, n)
+            self.create_item('node', node, hostname='node%d' % n)
+            for i in range(services):
+                self.create_inherited('/software/services/s%d' % i,
+                                      '%s/services/s%d' % (node, i))
+
+        for k in range(packages):
+            self.create_item('package', '/software/items/ms%d' % k,
+                             name='mspackage%d' % k)
+            self.create_inherited('/software/items/ms%d' % k,
+                                  '/ms/items/ms%d' % k)
+        for i in range(services):
+            self.create_inherited('/software/services/s%d' % i,
+                                  '/ms/services/s%d' % i)
+
+        for c in range(vcs_services):
+            self.create_item('vcs-clustered-service',
+                             '%s/services/cs%d' % (cluster, c),
+                             active=1, standby=0, name='cs%d' % c,
+                             online_timeout=45, node_list='n0')
+            self.create_item('service', '/software/services/vcs%d' % c,
+                             service_name='vcs%d' % c)
+            self.create_inherited(
+                '/software/services/vcs%d' % c,
+                '%s/services/cs%d/applications/vcs%d' % (cluster, c, c))
+
+    def plan_times(self):
+        """ Runs validate_model and create_configuration as a plan does,
+        REPEAT times, and returns the best time of each entry point along
+        with the errors and tasks of the last plan. Every plan gets a new
+        plugin, so no plan reuses the validation cache of the previous one.
+        """
+        validate_times = []
+        create_times = []
+        for _ in range(REPEAT):
+            plugin = ServicePlugin()
+            start = time.time()
+            errors = plugin.validate_model(self.api)
+            validated = time.time()
+            tasks = plugin.create_configuration(self.api)
+            validate_times.append(validated - start)
+            create_times.append(time.time() - validated)
+        return min(validate_times), min(create_times), errors, tasks
+
+    def run_scenario(self, name, nodes, services, packages, vcs_services=0):
+        self.setup_deployment(nodes, services, packages, vcs_services)
+        validate_time, create_time, errors, tasks = self.plan_times()
+        self.assertEqual([], errors)
+        self.assertEqual((nodes + 1) * services, len(tasks))
+
+        measured = {'validate_model': validate_time,
+                    'create_configuration': create_time}
+        self.measured[name] = dict(
+            (entry, round(seconds * BASELINE_HEADROOM, 3))
+            for entry, seconds in measured.items())
+        if UPDATE_BASELINE or not CHECK_TIMES:
+            return
+        baseline = self.baseline.get(name, {})
+        for entry, seconds in sorted(measured.items()):
+            self.assertTrue(entry in baseline,
+                'No baseline of %s for "%s" in %s, record one with '
+                'SERVICE_PLUGIN_BENCHMARK_UPDATE=1' %
+                (entry, name, BASELINE_FILE))
+            self.assertTrue(seconds <= baseline[entry],
+                '%s of "%s" took %.3fs, over its %.3fs baseline' %
+                (entry, name, seconds, baseline[entry]))
+
+    def test_small_deployment(self):
+        self.run_scenario('small', nodes=4, services=5, packages=50,
+                          vcs_services=2)
+
+    def test_medium_deployment(self):
+        self.run_scenario('medium', nodes=20, services=10, packages=200,
+                          vcs_services=5)
+
+    @unittest.skipUnless(RUN_LARGE, 'set SERVICE_PLUGIN_BENCHMARK=all')
+    def test_large_deployment(self):
+        self.run_scenario('large', nodes=60, services=20, packages=400,
+                          vcs_services=10)
+
+    @unittest.skipUnless(RUN_LARGE, 'set SERVICE_PLUGIN_BENCHMARK=all')
+    def test_200_nodes(self):
+        self.run_scenario('200_nodes', nodes=200, services=5, packages=100,
+                          vcs_services=10)